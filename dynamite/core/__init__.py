@@ -1,26 +1,136 @@
 # encoding: utf-8
 
+import math
+
+import numpy
+
+from dynamite.parser.expressions import diff, lambdify, share
+
+
 class PlanarSystem(object):
 
     def evaluate(self, x, y, t):
         raise NotImplementedError('evaluate()')
 
+    def evaluateMany(self, xs, ys, t):
+        # generic (slow) fallback, systems able to work on arrays should override this
+        xs, ys = _asPoints(xs, ys)
+        ts = numpy.broadcast_to(t, xs.shape)
+        dx, dy = numpy.empty(xs.shape), numpy.empty(xs.shape)
+
+        for i in numpy.ndindex(xs.shape):
+            dx[i], dy[i] = self.evaluate(xs[i], ys[i], ts[i])
+
+        return dx, dy
+
+    def jacobian(self, x, y, t):
+        # forward differences, systems that know their exact jacobian should override this
+        fx, fy = self.evaluate(x, y, t)
+
+        hx = _FD_STEP * max(1.0, abs(x))
+        hy = _FD_STEP * max(1.0, abs(y))
+
+        fxx, fyx = self.evaluate(x + hx, y, t)
+        fxy, fyy = self.evaluate(x, y + hy, t)
+
+        return ((fxx - fx) / hx, (fxy - fx) / hy), ((fyx - fy) / hx, (fyy - fy) / hy)
+
+    def parameters(self):
+        return {}
+
+    def isAutonomous(self):
+        # whether the field does not depend on t, unknown for a generic system
+        return False
+
     def formula(self):
         return u'(Formula Unavailable)'
 
 
 class ParsedSystem(PlanarSystem):
 
-    def __init__(self, dx, dy):
-        self._dx = dx
-        self._dy = dy
- 
+    VARIABLES = (u'x', u'y', u't')
+
+    def __init__(self, dx, dy, parameters={}):
+        # canonical (smallest) trees, so that every compiled evaluation is as cheap as possible
+        self._dx = share(dx.simplify())
+        self._dy = share(dy.simplify())
+
+        # any other symbol is a parameter, its value is passed to the compiled functions in a list
+        self._parameterNames = tuple(sorted((self._dx.symbols() | self._dy.symbols()) - set(self.VARIABLES)))
+        self._parameterIndex = dict((name, i) for i, name in enumerate(self._parameterNames))
+
+        missing = [name for name in self._parameterNames if name not in parameters]
+        if missing:
+            raise Exception(u'Parameter(s) without a value: %s' % u', '.join(missing))
+
+        self._p = [float(parameters[name]) for name in self._parameterNames]
+
+        self._compile()
+
+    def _compile(self):
+        self._f = lambdify([self._dx, self._dy], self.VARIABLES, parameters=self._parameterNames)
+        self._fMany = lambdify([self._dx, self._dy], self.VARIABLES, module='numpy', parameters=self._parameterNames)
+        self._J = None
+
+    # compiled functions can't be pickled (e.g. to send the system to another process), they are compiled again
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_f'], state['_fMany'], state['_J']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._dx, self._dy = share(self._dx), share(self._dy)
+        self._compile()
+
+    def copy(self):
+        # shares the compiled functions, which take the parameters as an argument, but has parameters of its own
+        system = object.__new__(type(self))
+        system.__dict__.update(self.__dict__)
+        system._p = list(self._p)
+        return system
+
+    def parameterNames(self):
+        return self._parameterNames
+
+    def parameters(self):
+        return dict(zip(self._parameterNames, self._p))
+
+    def setParameter(self, name, value):
+        if name not in self._parameterIndex:
+            raise Exception(u'Unknown parameter "%s"' % name)
+
+        self._p[self._parameterIndex[name]] = float(value)
+
+    def setParameters(self, values):
+        for name, value in values.items():
+            self.setParameter(name, value)
+
+    def isAutonomous(self):
+        return u't' not in (self._dx.symbols() | self._dy.symbols())
+
     def evaluate(self, x, y, t):
-        subs = {'x': x, 'y': y, 't': t}
+        return self._f(x, y, t, self._p)
+
+    def evaluateMany(self, xs, ys, t):
+        xs, ys = _asPoints(xs, ys)
+        dx, dy = self._fMany(xs, ys, t, self._p)
+
+        # constant components come back as scalars
+        return numpy.broadcast_to(dx, xs.shape), numpy.broadcast_to(dy, xs.shape)
+
+    def jacobian(self, x, y, t):
+        # exact jacobian, differentiated symbolically and compiled the first time it is needed
+        if self._J is None:
+            self._J = lambdify([[diff(self._dx, u'x'), diff(self._dx, u'y')],
+                                [diff(self._dy, u'x'), diff(self._dy, u'y')]],
+                               self.VARIABLES, parameters=self._parameterNames)
+
+        return self._J(x, y, t, self._p)
+
 
-        xN, yN = self._dx.simplify(subs), self._dy.simplify(subs)
+_FD_STEP = math.sqrt(numpy.finfo(float).eps)
 
-        if xN._header != 'Number' or yN._header != 'Number':
-            raise Exception('Evaluation did not return a number')
 
-        return xN.value(), yN.value()
\ No newline at end of file
+def _asPoints(xs, ys):
+    return numpy.broadcast_arrays(numpy.asarray(xs, dtype=float), numpy.asarray(ys, dtype=float))
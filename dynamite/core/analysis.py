@@ -0,0 +1,79 @@
+# encoding: utf-8
+
+import math
+
+import numpy
+
+from dynamite.core.integrators import _locate
+
+
+def findCycle(solution, direction=1, since=None, tolerance=1e-4):
+    # return map at one end: (t, period) if the orbit came back close to the end point on the section through it,
+    # t being the end of the first full loop on the cycle, or None
+    times, points = solution.times(), solution.points()
+
+    # work in the order of the integration, so that the end is the last point
+    if (direction < 0) != (len(times) > 1 and times[-1] < times[0]):
+        times, points = times[::-1], points[::-1]
+
+    if since is not None:
+        keep = direction * (times - since) >= 0.0
+        times, points = times[keep], points[keep]
+
+    if len(times) < 3:
+        return None
+
+    t1, (px, py) = times[-1], points[-1]
+    fx, fy = solution.system().evaluate(px, py, t1)
+    nx, ny = direction * fx, direction * fy
+
+    if nx == 0.0 and ny == 0.0:
+        return None
+
+    # an orbit spiralling into a fixed point comes back ever closer, but not relative to the size of its loops
+    extent = numpy.ptp(points, axis=0).max()
+
+    # crossings in the sense of the flow, the end point itself is on the section
+    g = (points[:, 0] - px) * nx + (points[:, 1] - py) * ny
+    i = numpy.nonzero((g[:-2] < 0.0) & (g[1:-1] >= 0.0))[0]
+
+    # cheap filter on the chords, only the crossings that may be close are located on the dense output
+    w = -g[i] / (g[i + 1] - g[i])
+    chords = points[i + 1] - points[i]
+    d = numpy.hypot(points[i, 0] + w * chords[:, 0] - px, points[i, 1] + w * chords[:, 1] - py)
+    i = i[d <= tolerance * extent + numpy.hypot(chords[:, 0], chords[:, 1])]
+
+    # close returns, most recent first
+    returns = []
+    for k in i[::-1]:
+        t = _crossing(solution, times[k], times[k + 1], px, py, nx, ny)
+        x, y = solution.sample([t])
+
+        if math.hypot(x[0] - px, y[0] - py) > tolerance * numpy.ptp(points[k:], axis=0).max():
+            if returns:
+                break
+            continue
+
+        period = abs(t1 - (returns[0] if returns else t))
+
+        # the returns to a cycle are a period apart, anything else is another part of the orbit
+        if returns and abs(returns[-1] - t) > 1.5 * period:
+            break
+
+        returns.append(t)
+
+    if not returns:
+        return None
+
+    # the earliest return is where the orbit reached the cycle, the loop from there closes a period later
+    period = t1 - returns[0]
+    return returns[-1] + period, abs(period)
+
+
+def _crossing(solution, ta, tb, px, py, nx, ny):
+    # time of the crossing of the section between ta and tb, on the dense output
+    def g(s):
+        xs, ys = solution.sample([ta + s * (tb - ta)])
+        return (xs[0] - px) * nx + (ys[0] - py) * ny
+
+    return ta + _locate(g, tol=1e-9) * (tb - ta)
@@ -0,0 +1,73 @@
+# encoding: utf-8
+
+import math
+
+
+class Event(object):
+    # condition located where value() changes sign (direction: 1 increasing, -1 decreasing, 0 both); terminal events
+    # stop the integration, atStart events also happen when the orbit starts past them
+
+    terminal = False
+    direction = 0
+    atStart = False
+
+    def value(self, t, x, y):
+        raise NotImplementedError('value()')
+
+
+class BoundingBox(Event):
+    # leaving the rectangle [x0, x1] x [y0, y1]
+
+    terminal = True
+    direction = -1
+    atStart = True
+
+    def __init__(self, x0, y0, x1, y1):
+        self.x0, self.y0, self.x1, self.y1 = x0, y0, x1, y1
+
+    def value(self, t, x, y):
+        # distance to the nearest side, negative outside
+        return min(x - self.x0, self.x1 - x, y - self.y0, self.y1 - y)
+
+
+class MinimumSpeed(Event):
+    # speed falling below epsilon (e.g. converging to a fixed point)
+
+    terminal = True
+    direction = -1
+    atStart = True
+
+    def __init__(self, system, epsilon=1e-6):
+        self.system = system
+        self.epsilon = epsilon
+
+    def value(self, t, x, y):
+        dx, dy = self.system.evaluate(x, y, t)
+        return math.hypot(dx, dy) - self.epsilon
+
+
+class Section(Event):
+    # crossing the line through point perpendicular to normal (e.g. a Poincare section)
+
+    def __init__(self, point, normal, direction=0, terminal=False):
+        self.px, self.py = point
+        self.nx, self.ny = normal
+        self.direction = direction
+        self.terminal = terminal
+
+    def value(self, t, x, y):
+        return (x - self.px) * self.nx + (y - self.py) * self.ny
+
+
+class Return(Event):
+    # coming back within radius of point, which should be larger than a step
+
+    terminal = True
+    direction = -1
+
+    def __init__(self, point, radius):
+        self.px, self.py = point
+        self.radius = radius
+
+    def value(self, t, x, y):
+        return math.hypot(x - self.px, y - self.py) - self.radius
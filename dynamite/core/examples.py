@@ -2,6 +2,8 @@
 
 import math
 
+import numpy
+
 from dynamite.core import PlanarSystem
 
 
@@ -15,3 +17,7 @@ class Pendulum2D(PlanarSystem):
 
     def evaluate(self, x, y, t):
         return [-y + math.cos(2*x), x+math.sin(2*y)]
+
+    def evaluateMany(self, xs, ys, t):
+        return -ys + numpy.cos(2*xs), xs + numpy.sin(2*ys)
+
@@ -1,17 +1,131 @@
 # encoding: utf-8
 
-from PySide.QtCore import QPointF
+import math
+
+import numpy
+
+from dynamite.core import _FD_STEP
+from dynamite.core.trajectory import Trajectory
+
+
+class Solution(Trajectory):
+    # trajectory of an integrator, with a cubic Hermite interpolant between its points (slopes evaluated on demand)
+
+    def __init__(self, system, capacity=64):
+        super(Solution, self).__init__(capacity)
+        self._system = system
+        self._events = []
+        self._cycles = {}
+        self._finished = set()
+
+    def system(self):
+        return self._system
+
+    def events(self):
+        # (t, x, y, event) of the events found while integrating, in order
+        return self._events
+
+    def addEvent(self, t, x, y, event):
+        self._events.append((t, x, y, event))
+
+    def cycle(self, direction):
+        # (t, period) of the cycle found at the forward (1) or backward (-1) end, or None
+        return self._cycles.get(direction)
+
+    def setCycle(self, direction, t, period):
+        self._cycles[direction] = (t, period)
+
+    # an end is finished when integrating further from it is pointless (fixed point, escape, cycle, error)
+    def finished(self, direction):
+        return direction in self._finished
+
+    def setFinished(self, direction):
+        self._finished.add(direction)
+
+    def truncate(self, start, end):
+        super(Solution, self).truncate(start, end)
+
+        # events of the dropped steps go too
+        t0, t1 = sorted((self.first()[0], self.last()[0]))
+        self._events = [event for event in self._events if t0 <= event[0] <= t1]
+
+    def copy(self, system=None):
+        # the copy may belong to another system with the same field (e.g. a copy of this one)
+        sol = Solution(system or self._system, len(self))
+        sol.extend(self.data())
+        sol._events = list(self._events)
+        sol._cycles = dict(self._cycles)
+        sol._finished = set(self._finished)
+        return sol
+
+    def _slopes(self, i):
+        points = self.points()
+        return self._system.evaluateMany(points[i, 0], points[i, 1], self.times()[i])
+
+    def sample(self, ts):
+        # x and y arrays of the interpolant at the times ts
+        times, points = self.times(), self.points()
+        ts = numpy.asarray(ts, dtype=numpy.float64)
+
+        if len(times) == 1:
+            return numpy.full(ts.shape, points[0, 0]), numpy.full(ts.shape, points[0, 1])
+
+        # searchsorted needs increasing times, backward orbits are stored in decreasing order
+        sign = -1.0 if times[-1] < times[0] else 1.0
+
+        i = numpy.clip(numpy.searchsorted(sign * times, sign * ts, side='right') - 1, 0, len(times) - 2)
+        h = times[i + 1] - times[i]
+        s = (ts - times[i]) / h
+
+        # only the steps that are actually sampled need their slopes
+        nodes, inverse = numpy.unique(numpy.concatenate((i, i + 1)), return_inverse=True)
+        dx, dy = self._slopes(nodes)
+        dx0, dx1 = numpy.split(dx[inverse], 2)
+        dy0, dy1 = numpy.split(dy[inverse], 2)
+
+        xs = _hermite(s, h, points[i, 0], points[i + 1, 0], dx0, dx1)
+        ys = _hermite(s, h, points[i, 1], points[i + 1, 1], dy0, dy1)
+
+        return xs, ys
+
+    def refinedTimes(self, maxLength, sx=1.0, sy=1.0, maxSubdivisions=64, steps=None):
+        # times of the steps (all by default) subdivided so that no chord scaled by (sx, sy) is longer than maxLength,
+        # and the run (of consecutive steps) of every time; each run ends with its last time
+        times, points = self.times(), self.points()
+
+        if steps is None:
+            steps = numpy.arange(len(times) - 1)
+
+        if len(steps) == 0:
+            return numpy.empty(0), numpy.empty(0, dtype=int)
+
+        d = points[steps + 1] - points[steps]
+        n = numpy.clip(numpy.ceil(numpy.hypot(d[:, 0] * sx, d[:, 1] * sy) / maxLength), 1, maxSubdivisions)
+
+        # the last step of a run also gets its end time
+        first = numpy.insert(steps[1:] != steps[:-1] + 1, 0, True)
+        last = numpy.append(first[1:], True)
+        count = n.astype(int) + last
+
+        # every step i contributes t_i + k*(t_{i+1} - t_i)/n[i], k = 0..count[i]-1
+        start = numpy.repeat(times[steps], count)
+        step = numpy.repeat((times[steps + 1] - times[steps]) / n, count)
+        k = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count)
+
+        return start + k * step, numpy.repeat(numpy.cumsum(first), count)
 
 
 class RungeKutta4(object):
 
     @classmethod
-    def solve(cls, system, x0, y0, t0, steps=20):
-        H = 0.05
-        sol = []
-
-        xp = QPointF(x0, y0)
-        sol.append(xp)
+    def solve(cls, system, x0, y0, t0, steps=20, h=0.05, events=()):
+        # a negative step integrates backward in time
+        H = h
+        sol = Solution(system, steps + 1)
+        sol.append(t0, x0, y0)
+        monitor = _EventMonitor(events, sol)
+        if monitor.stopped:
+            return sol
 
         xval = x0
         yval = y0
@@ -39,6 +153,319 @@ class RungeKutta4(object):
             xval = xval + H*(L1+2*L2+2*L3+L4)/6;
             yval = yval + H*(M1+2*M2+2*M3+M4)/6;
 
-            sol.append(QPointF(xval, yval))
+            sol.append(tval, xval, yval)
+
+            if monitor.step(sol):
+                break
     
         return sol
+
+
+class DormandPrince45(object):
+
+    # Butcher tableau of the Dormand-Prince 5(4) pair. The last stage is evaluated at the new point, so it is
+    # reused as the first stage of the next step (FSAL).
+    C = (0.0, 1.0/5, 3.0/10, 4.0/5, 8.0/9, 1.0, 1.0)
+    A = ((),
+         (1.0/5,),
+         (3.0/40, 9.0/40),
+         (44.0/45, -56.0/15, 32.0/9),
+         (19372.0/6561, -25360.0/2187, 64448.0/6561, -212.0/729),
+         (9017.0/3168, -355.0/33, 46732.0/5247, 49.0/176, -5103.0/18656),
+         (35.0/384, 0.0, 500.0/1113, 125.0/192, -2187.0/6784, 11.0/84))
+    # difference between the 5th and 4th order weights
+    E = (71.0/57600, 0.0, -71.0/16695, 71.0/1920, -17253.0/339200, 22.0/525, -1.0/40)
+
+    @classmethod
+    def solve(cls, system, x0, y0, t0, t1, rtol=1e-6, atol=1e-8, maxSteps=10000, events=()):
+        # adaptive steps from t0 to t1 (which may be before t0), stopped early by a terminal event or a collapsing step
+        direction = 1.0 if t1 >= t0 else -1.0
+
+        xval, yval, tval = x0, y0, t0
+        fx, fy = system.evaluate(xval, yval, tval)
+        h = _initialStep(system, xval, yval, tval, fx, fy, direction, 5, rtol, atol)
+
+        sol = Solution(system)
+        sol.append(tval, xval, yval)
+        monitor = _EventMonitor(events, sol)
+
+        while not monitor.stopped and direction * (t1 - tval) > 0.0 and len(sol) <= maxSteps:
+            if _stepTooSmall(h, tval):
+                # e.g. the solution blows up in finite time, it ends at the last accepted step
+                sol.setFinished(int(direction))
+                break
+
+            h = min(h, abs(t1 - tval))
+
+            K = [(fx, fy)]
+            for i in xrange(1, 7):
+                xs = xval + direction * h * sum(a * k[0] for a, k in zip(cls.A[i], K))
+                ys = yval + direction * h * sum(a * k[1] for a, k in zip(cls.A[i], K))
+                K.append(system.evaluate(xs, ys, tval + direction * h * cls.C[i]))
+
+            # 5th order solution is the argument of the last stage
+            ex = direction * h * sum(e * k[0] for e, k in zip(cls.E, K))
+            ey = direction * h * sum(e * k[1] for e, k in zip(cls.E, K))
+            err = _errorNorm(ex, ey, xval, yval, xs, ys, rtol, atol)
+
+            if err <= 1.0:
+                tval = tval + direction * h
+                xval, yval = xs, ys
+                fx, fy = K[6]
+
+                sol.append(tval, xval, yval)
+
+                if monitor.step(sol):
+                    break
+
+            h = h * _stepFactor(err, 5)
+
+        sol.trim()
+        return sol
+
+
+class Rosenbrock23(object):
+
+    # Shampine & Reichelt, "The MATLAB ODE Suite" (ode23s). The method is L-stable, so step sizes are limited by
+    # accuracy only and stiff systems can be integrated with steps far larger than explicit methods allow.
+    D = 1.0 / (2.0 + math.sqrt(2.0))
+    E32 = 6.0 + math.sqrt(2.0)
+
+    @classmethod
+    def solve(cls, system, x0, y0, t0, t1, rtol=1e-3, atol=1e-6, maxSteps=10000, events=()):
+        # adaptive steps from t0 to t1 (which may be before t0) using system.jacobian(), stopped by a terminal event or a
+        # collapsing step
+        direction = 1.0 if t1 >= t0 else -1.0
+        d = cls.D
+
+        xval, yval, tval = x0, y0, t0
+        F0 = system.evaluate(xval, yval, tval)
+        h = _initialStep(system, xval, yval, tval, F0[0], F0[1], direction, 3, rtol, atol)
+
+        sol = Solution(system)
+        sol.append(tval, xval, yval)
+        monitor = _EventMonitor(events, sol)
+
+        while not monitor.stopped and direction * (t1 - tval) > 0.0 and len(sol) <= maxSteps:
+            if _stepTooSmall(h, tval):
+                sol.setFinished(int(direction))
+                break
+
+            h = min(h, abs(t1 - tval))
+            hs = direction * h
+
+            J = system.jacobian(xval, yval, tval)
+
+            # time derivative of the field, zero for autonomous systems
+            dt = _FD_STEP * max(1.0, abs(tval))
+            Ft = system.evaluate(xval, yval, tval + dt)
+            T = ((Ft[0] - F0[0]) / dt, (Ft[1] - F0[1]) / dt)
+
+            # W = I - h*d*J
+            w00, w01 = 1.0 - hs * d * J[0][0], -hs * d * J[0][1]
+            w10, w11 = -hs * d * J[1][0], 1.0 - hs * d * J[1][1]
+            det = w00 * w11 - w01 * w10
+
+            if det == 0.0:
+                h = h * 0.5
+                continue
+
+            def W(bx, by):
+                return (w11 * bx - w01 * by) / det, (w00 * by - w10 * bx) / det
+
+            k1 = W(F0[0] + hs * d * T[0], F0[1] + hs * d * T[1])
+            F1 = system.evaluate(xval + 0.5 * hs * k1[0], yval + 0.5 * hs * k1[1], tval + 0.5 * hs)
+            k2 = W(F1[0] - k1[0], F1[1] - k1[1])
+            k2 = (k2[0] + k1[0], k2[1] + k1[1])
+
+            xs, ys = xval + hs * k2[0], yval + hs * k2[1]
+            F2 = system.evaluate(xs, ys, tval + hs)
+            k3 = W(F2[0] - cls.E32 * (k2[0] - F1[0]) - 2.0 * (k1[0] - F0[0]) + hs * d * T[0],
+                   F2[1] - cls.E32 * (k2[1] - F1[1]) - 2.0 * (k1[1] - F0[1]) + hs * d * T[1])
+
+            ex = hs / 6.0 * (k1[0] - 2.0 * k2[0] + k3[0])
+            ey = hs / 6.0 * (k1[1] - 2.0 * k2[1] + k3[1])
+            err = _errorNorm(ex, ey, xval, yval, xs, ys, rtol, atol)
+
+            if err <= 1.0:
+                tval = tval + hs
+                xval, yval = xs, ys
+                F0 = F2
+
+                sol.append(tval, xval, yval)
+
+                if monitor.step(sol):
+                    break
+
+            h = h * _stepFactor(err, 3, maxFactor=5.0)
+
+        sol.trim()
+        return sol
+
+
+class BatchRungeKutta4(object):
+
+    # integrates many orbits at once, from an array of initial points
+    batch = True
+
+    @classmethod
+    def solve(cls, system, points, t0, steps=20, h=0.05):
+        # orbits of all the (N,2) initial points in lockstep, returns a (N, steps+1, 2) array
+        H = h
+
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        sol = numpy.empty((points.shape[0], steps + 1, 2), dtype=numpy.float64)
+        sol[:, 0] = points
+
+        xval = points[:, 0].copy()
+        yval = points[:, 1].copy()
+        tval = t0
+
+        for n in xrange(0, steps):
+            L1, M1 = system.evaluateMany(xval, yval, tval)
+            t1 = tval + H/2
+            L2, M2 = system.evaluateMany(xval + H*L1/2, yval + H*M1/2, t1)
+            L3, M3 = system.evaluateMany(xval + H*L2/2, yval + H*M2/2, t1)
+            tval = tval + H
+            L4, M4 = system.evaluateMany(xval + H*L3, yval + H*M3, tval)
+
+            xval += H*(L1+2*L2+2*L3+L4)/6
+            yval += H*(M1+2*M2+2*M3+M4)/6
+
+            sol[:, n + 1, 0] = xval
+            sol[:, n + 1, 1] = yval
+
+        return sol
+
+
+class _EventMonitor(object):
+    # checks the events after every step of an integrator, sign changes are located on the dense output of the step
+
+    def __init__(self, events, sol):
+        t, x, y = sol.last()
+        self._events = tuple(events)
+        self._values = [event.value(t, x, y) for event in self._events]
+
+        # an orbit that starts past a terminal atStart event (e.g. already slower than MinimumSpeed) ends right there
+        self.stopped = False
+        for event, g in zip(self._events, self._values):
+            if event.terminal and event.atStart and g * event.direction >= 0.0:
+                sol.addEvent(t, x, y, event)
+                self.stopped = True
+                break
+
+    def step(self, sol):
+        # checks the last step of sol, returns True if a terminal event ended the integration there
+        if not self._events:
+            return False
+
+        t, x, y = sol.last()
+        values = [event.value(t, x, y) for event in self._events]
+
+        crossed = [event for event, g0, g1 in zip(self._events, self._values, values)
+                   if (g0 < 0.0 <= g1 and event.direction >= 0) or (g0 > 0.0 >= g1 and event.direction <= 0)]
+        self._values = values
+
+        if not crossed:
+            return False
+
+        # cubic Hermite interpolant of the last step, as a function of s in [0, 1]
+        (t0, x0, y0), (t1, x1, y1) = sol.data()[-2:]
+        (dx0, dx1), (dy0, dy1) = sol._slopes(numpy.array([-2, -1]))
+        h = t1 - t0
+
+        def state(s):
+            return t0 + s * h, _hermite(s, h, x0, x1, dx0, dx1), _hermite(s, h, y0, y1, dy0, dy1)
+
+        found = sorted(((_locate(lambda s: event.value(*state(s))), event) for event in crossed), key=lambda f: f[0])
+
+        for s, event in found:
+            t, x, y = state(s)
+            sol.addEvent(t, x, y, event)
+
+            if event.terminal:
+                # the orbit ends at the event
+                sol.data()[-1] = (t, x, y)
+                self.stopped = True
+                return True
+
+        return False
+
+
+def _hermite(s, h, p0, p1, d0, d1):
+    # cubic Hermite basis, slopes are d/dt so they are scaled by the step
+    s2, s3 = s * s, s * s * s
+    return (2*s3 - 3*s2 + 1) * p0 + (s3 - 2*s2 + s) * h * d0 + (-2*s3 + 3*s2) * p1 + (s3 - s2) * h * d1
+
+
+def _locate(g, tol=1e-12, maxIterations=60):
+    # Illinois (modified regula falsi) on [0, 1], where g changes sign. The end after the crossing is returned, so
+    # that the point found satisfies the event.
+    a, b = 0.0, 1.0
+    ga, gb = g(a), g(b)
+    side = 0
+
+    for n in xrange(maxIterations):
+        if b - a <= tol or gb == ga:
+            break
+
+        c = (a * gb - b * ga) / (gb - ga)
+        gc = g(c)
+
+        if gc == 0.0:
+            return c
+
+        if (gc < 0.0) == (ga < 0.0):
+            a, ga = c, gc
+            if side == -1:
+                gb *= 0.5
+            side = -1
+        else:
+            b, gb = c, gc
+            if side == 1:
+                ga *= 0.5
+            side = 1
+
+    return b
+
+
+def _errorNorm(ex, ey, x0, y0, x1, y1, rtol, atol):
+    return max(abs(ex) / (atol + rtol * max(abs(x0), abs(x1))),
+               abs(ey) / (atol + rtol * max(abs(y0), abs(y1))))
+
+
+def _stepFactor(err, order, safety=0.9, minFactor=0.2, maxFactor=10.0):
+    if err == 0.0:
+        return maxFactor
+
+    # e.g. overflow near a blow-up, the step is rejected and shrinks as much as possible
+    if math.isnan(err) or math.isinf(err):
+        return minFactor
+
+    factor = safety * err ** (-1.0 / order)
+
+    if err > 1.0:
+        return max(minFactor, min(factor, 1.0))
+    return max(1.0, min(factor, maxFactor))
+
+
+def _stepTooSmall(h, t):
+    # a step this small can't resolve the solution anymore (e.g. it blows up in finite time)
+    return h < 16 * numpy.finfo(float).eps * max(1.0, abs(t))
+
+
+def _initialStep(system, x0, y0, t0, fx, fy, direction, order, rtol, atol):
+    # Hairer, Norsett & Wanner, "Solving Ordinary Differential Equations I", II.4
+    d0 = _errorNorm(x0, y0, x0, y0, x0, y0, rtol, atol)
+    d1 = _errorNorm(fx, fy, x0, y0, x0, y0, rtol, atol)
+    h0 = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01 * d0 / d1
+
+    fx1, fy1 = system.evaluate(x0 + direction * h0 * fx, y0 + direction * h0 * fy, t0 + direction * h0)
+    d2 = _errorNorm(fx1 - fx, fy1 - fy, x0, y0, x0, y0, rtol, atol) / h0
+
+    if max(d1, d2) <= 1e-15:
+        h1 = max(1e-6, h0 * 1e-3)
+    else:
+        h1 = (0.01 / max(d1, d2)) ** (1.0 / order)
+
+    return min(100 * h0, h1)
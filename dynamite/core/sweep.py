@@ -0,0 +1,64 @@
+# encoding: utf-8
+
+import copy
+import itertools
+import multiprocessing
+
+import numpy
+
+from dynamite.core.integrators import BatchRungeKutta4
+
+
+def sweep(system, grid, points, t0=0.0, steps=400, h=0.05, integrator=BatchRungeKutta4, processes=None):
+    # orbits of the (N,2) points for every combination of the values in grid (name -> values), on a process pool;
+    # returns an array of shape (len(v1), ..., len(vk), N, steps+1, 2), parameters sorted by name. The integrator
+    # takes fixed steps of h: a batch one (all the points at once) or e.g. RungeKutta4 (one point at a time)
+    names = sorted(grid)
+    values = [list(grid[name]) for name in names]
+    combinations = list(itertools.product(*values))
+
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    shape = tuple(len(v) for v in values) + (len(points), steps + 1, 2)
+
+    if not combinations:
+        return numpy.empty(shape)
+
+    # the parameters are set on a copy, the system may be shared (e.g. by the plots of the parser's cache)
+    system = copy.deepcopy(system)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(combinations)))
+
+    # a few chunks per process, so that the work stays balanced when some combinations are slower
+    size = max(1, len(combinations) // (4 * processes))
+    chunks = [(system, names, combinations[i:i + size], points, t0, steps, h, integrator)
+              for i in xrange(0, len(combinations), size)]
+
+    if processes == 1:
+        results = map(_sweepChunk, chunks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_sweepChunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    return numpy.concatenate(results).reshape(shape)
+
+
+def _sweepChunk(args):
+    system, names, combinations, points, t0, steps, h, integrator = args
+
+    result = numpy.empty((len(combinations), len(points), steps + 1, 2), dtype=numpy.float64)
+    for i, combination in enumerate(combinations):
+        system.setParameters(dict(zip(names, combination)))
+
+        if getattr(integrator, 'batch', False):
+            result[i] = integrator.solve(system, points, t0, steps, h)
+        else:
+            for j, (x, y) in enumerate(points):
+                result[i, j] = integrator.solve(system, x, y, t0, steps, h).points()
+
+    return result
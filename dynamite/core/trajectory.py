@@ -0,0 +1,82 @@
+# encoding: utf-8
+
+import numpy
+
+
+class Trajectory(object):
+    # points of an orbit as (t, x, y) rows of a float64 buffer, which grows at both ends
+
+    COLUMNS = 3
+
+    def __init__(self, capacity=64):
+        self._buffer = numpy.empty((max(1, capacity), self.COLUMNS), dtype=numpy.float64)
+        self._start = 0
+        self._end = 0
+
+    def _reserve(self, front, back):
+        # room for front more rows before the first one and back more rows after the last one
+        if self._start >= front and len(self._buffer) - self._end >= back:
+            return
+
+        # grows from the live size, and the spare room is split between both ends, since orbits grow at both
+        size = self._end - self._start
+        capacity = max(len(self._buffer), 2 * size + front + back)
+        start = front + (capacity - size - front - back) // 2
+
+        buffer = numpy.empty((capacity, self.COLUMNS), dtype=numpy.float64)
+        buffer[start:start + size] = self._buffer[self._start:self._end]
+
+        self._buffer = buffer
+        self._start, self._end = start, start + size
+
+    def append(self, t, x, y):
+        self._reserve(0, 1)
+
+        row = self._buffer[self._end]
+        row[0], row[1], row[2] = t, x, y
+        self._end += 1
+
+    def extend(self, rows):
+        rows = numpy.asarray(rows, dtype=numpy.float64).reshape(-1, self.COLUMNS)
+
+        self._reserve(0, len(rows))
+        self._buffer[self._end:self._end + len(rows)] = rows
+        self._end += len(rows)
+
+    def prepend(self, rows):
+        rows = numpy.asarray(rows, dtype=numpy.float64).reshape(-1, self.COLUMNS)
+
+        self._reserve(len(rows), 0)
+        self._buffer[self._start - len(rows):self._start] = rows
+        self._start -= len(rows)
+
+    def truncate(self, start, end):
+        # keeps the rows [start, end) only, the buffer is not copied
+        start, end, step = slice(start, end).indices(len(self))
+        self._start, self._end = self._start + start, self._start + max(start, end)
+
+    def trim(self):
+        if len(self) < len(self._buffer):
+            self._buffer = self._buffer[self._start:max(self._start + 1, self._end)].copy()
+            self._start, self._end = 0, self._end - self._start
+
+    def data(self):
+        return self._buffer[self._start:self._end]
+
+    def times(self):
+        return self._buffer[self._start:self._end, 0]
+
+    def points(self):
+        return self._buffer[self._start:self._end, 1:]
+
+    def first(self):
+        return tuple(self._buffer[self._start])
+
+    def last(self):
+        return tuple(self._buffer[self._end - 1])
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, i):
+        return self.data()[i]
@@ -0,0 +1,27 @@
+# encoding: utf-8
+
+import multiprocessing
+
+_pool = None
+
+
+def solverPool():
+    # process pool shared by the plots, orbits are integrated out of the GUI thread and on every core
+    global _pool
+
+    if _pool is None:
+        _pool = multiprocessing.Pool()
+
+    return _pool
+
+
+def solveAsync(integrator, args, callback):
+    # callback gets (in a thread of the pool) the solution, or the exception raised while solving
+    return solverPool().apply_async(_solve, (integrator, args), callback=callback)
+
+
+def _solve(integrator, args):
+    try:
+        return integrator.solve(*args)
+    except Exception as e:
+        return e
@@ -1,13 +1,21 @@
 # encoding: utf-8
 
-import StringIO
-import token, tokenize
+import re
 
 from dynamite.parser import expressions as expr
+from dynamite.utils import LRUCache
 
 
 class ParserException(Exception):
-    pass
+
+    def __init__(self, message, position=None):
+        self.reason = message
+        self.position = position
+
+        if position is not None:
+            message = u'%s (at position %d)' % (message, position)
+
+        super(ParserException, self).__init__(message)
 
 
 class Token(object):
@@ -34,12 +42,17 @@ class Token(object):
         PLUS: 50,
         MINUS: 50,
         MUL: 60,
-        DIV: 60
+        DIV: 60,
+        EXP: 70
     }
 
-    def __init__(self, kind=0, value=''):
+    __slots__ = ('kind', 'value', 'position', 'lbp')
+
+    def __init__(self, kind=0, value='', position=None):
         self.kind = kind
         self.value = value
+        self.position = position
+        self.lbp = Token._OP_BINDING.get(kind, 0)
 
     def isNumber(self):
         return self.kind == Token.NUMBER
@@ -50,10 +63,6 @@ class Token(object):
     def isOperator(self):
         return self.kind in (Token.PLUS, Token.MINUS, Token.MUL, Token.DIV, Token.EXP, Token.EQUAL)
 
-    @property
-    def lbp(self):
-        return Token._OP_BINDING.get(self.kind, 0)
-
     def __repr__(self):
         return u'<%s: %s>' % (self.kind, self.value)
 
@@ -68,51 +77,34 @@ class ExpressionParser(object):
         self._pos = -1
 
     # Token-related
+    _LEXEME = re.compile(r'\s*(?:(?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)|'
+                         r'(?P<name>[A-Za-z_][A-Za-z_0-9]*)|'
+                         r'(?P<op>[-+*/^(){}=,]))')
+
     @classmethod
     def tokenize(cls, text):
-        # token_pat = re.compile("\s*(?:(\d+)|(.))")
-
         tokens = []
 
-        for toknum, tokval, _, _, _ in tokenize.generate_tokens(StringIO.StringIO(text).readline):
-            type_ = Token.UNKNOWN
+        pos = 0
+        end = len(text.rstrip())
+        match = cls._LEXEME.match
 
-            if token.ISEOF(toknum):
-                type_ = Token.END
+        while pos < end:
+            m = match(text, pos)
+
+            if m is None:
+                pos = len(text) - len(text[pos:].lstrip())
+                raise ParserException(u'Unexpected character "%s"' % text[pos], pos)
+
+            kind = m.lastgroup
+            if kind == 'op':
+                tokens.append(Token(m.group(kind), m.group(kind), m.start(kind)))
             else:
-                if toknum == token.NUMBER:
-                    type_ = Token.NUMBER
-                elif toknum == token.NAME:
-                    type_ = Token.NAME
-                elif toknum == token.OP:
-                    # python uses token.OP both for delimiters and operators, so we need to know more
-                    if tokval == '+':
-                        type_ = Token.PLUS
-                    elif tokval == '-':
-                        type_ = Token.MINUS
-                    elif tokval == '*':
-                        type_ = Token.MUL
-                    elif tokval == '/':
-                        type_ = Token.DIV
-                    elif tokval == '^':
-                        type_ = Token.EXP
-                    elif tokval == '(':
-                        type_ = Token.LPAR
-                    elif tokval == ')':
-                        type_ = Token.RPAR
-                    elif tokval == '{':
-                        type_ = Token.LBRACE
-                    elif tokval == '}':
-                        type_ = Token.RBRACE
-                    elif tokval == '=':
-                        type_ = Token.EQUAL
-                    elif tokval == ',':
-                        type_ = Token.COMMA
-                elif toknum == token.EQUAL:
-                    type_ = Token.EQUAL
-
-            tokens.append(Token(type_, tokval))
+                tokens.append(Token(Token.NUMBER if kind == 'number' else Token.NAME, m.group(kind), m.start(kind)))
 
+            pos = m.end()
+
+        tokens.append(Token(Token.END, u'', len(text)))
         return tokens
 
     def _token(self):
@@ -127,13 +119,13 @@ class ExpressionParser(object):
 
     def _nextToken(self, expectedToken=None):
         if expectedToken is not None and self._token().kind != expectedToken:
-            raise Exception(u'Expected %s' % expectedToken)
+            raise ParserException(u'Expected "%s"' % expectedToken, self._token().position)
 
         if self._pos < (len(self._tokens) - 1):
             self._pos += 1
             return self._token()
 
-        raise Exception(u'No next token')
+        raise ParserException(u'Unexpected end of formula', self._token().position)
 
     def _peekToken(self):
         if self._pos < (len(self._tokens) - 1):
@@ -147,18 +139,34 @@ class ExpressionParser(object):
         self._tokens = ExpressionParser.tokenize(text)
 
         self._nextToken()
-        return self._expression()
+        e = self._expression()
+
+        if self._token().kind != Token.END:
+            raise ParserException(u'Unexpected "%s"' % self._token().value, self._token().position)
+
+        return e
 
     def _nud(self, token):
         if token.isNumber():
             return expr.Expr(u'Number', float(token.value))
         elif token.isName():
             if self._token().kind == Token.LPAR:
-                # we only support numeric functions of 1 argument
-                self._nextToken()
-                e = expr.Expr_NumericFunction(token.value, self._expression(0))
+                if token.value not in expr.Expr_NumericFunction.ALLOWED_FUNCTIONS:
+                    raise ParserException(u'Unknown function "%s"' % token.value, token.position)
+
                 self._nextToken()
-                return e
+                args = [self._expression(0)]
+
+                while self._token().kind == Token.COMMA:
+                    self._nextToken(Token.COMMA)
+                    args.append(self._expression(0))
+
+                self._nextToken(Token.RPAR)
+
+                try:
+                    return expr.Expr_NumericFunction(token.value, args)
+                except Exception as e:
+                    raise ParserException(unicode(e), token.position)
 
             return expr.Expr(u'Symbol', unicode(token.value))
         elif token.kind == Token.LBRACE:
@@ -178,17 +186,20 @@ class ExpressionParser(object):
                     # if self._token().kind != Token.COMMA:
                     #     parts.append(self._expression(0))
 
-                self._nextToken(Token.RBRACE)
+            self._nextToken(Token.RBRACE)
 
             return expr.Expr_List(parts)
         elif token.kind == Token.MINUS:
-            return expr.Expr_Mul([expr.Expr(u'Number', -1.0), self._expression(100)]) # unary version
+            # unary version, binds tighter than * and / but not ^ (-x^2 is -(x^2))
+            return expr.Expr_Mul([expr.Expr(u'Number', -1.0), self._expression(65)])
         elif token.kind == Token.LPAR:
             e = self._expression(0)
             self._nextToken(Token.RPAR)
             return e
 
-        return None
+        if token.kind == Token.END:
+            raise ParserException(u'Unexpected end of formula', token.position)
+        raise ParserException(u'Unexpected "%s"' % token.value, token.position)
 
 
     def _led(self, token, l):
@@ -201,6 +212,9 @@ class ExpressionParser(object):
                 return expr.Expr_Mul([l, self._expression(token.lbp)])
             elif token.kind == Token.DIV:
                 return expr.Expr_Div([l, self._expression(token.lbp)])
+            elif token.kind == Token.EXP:
+                # right associative: x^y^z is x^(y^z)
+                return expr.Expr_Pow([l, self._expression(token.lbp - 1)])
             return expr.Expr(token.kind, [l, self._expression(token.lbp)])
 
         return None
@@ -266,8 +280,112 @@ class ExpressionParser(object):
     #         raise Exception('expected a factor')
 
 
+# parsed expressions, keyed on normalized formula text
+_expressionCache = LRUCache(256)
+# compiled systems, keyed on the (canonical) dx/dt and dy/dt expressions
+_systemCache = LRUCache(64)
+# solved orbits, keyed on the system and the initial point
+_solutionCache = LRUCache(256)
+
+
+def normalize(text):
+    return u' '.join(text.split())
+
+
+def clearCache():
+    _expressionCache.invalidate()
+    _systemCache.invalidate()
+    _solutionCache.invalidate()
+
+
+def _cacheSolution(key, values, solution):
+    # an orbit solved after the parameters of its system changed does not belong under the key anymore (the cache
+    # holds the orbit of the plot, which was just extended in place)
+    if solution.system().parameters() == values:
+        _solutionCache.put(key, solution)
+    elif _solutionCache.get(key) is solution:
+        _solutionCache.invalidate(key)
+
+
+class IncrementalParser(object):
+    # parses a formula that is being edited, only the list elements that changed are parsed again
+
+    def __init__(self):
+        self._elements = {}
+
+    def parse(self, text):
+        parts = _splitList(text)
+
+        if parts is None:
+            return parse(text)
+
+        elements = {}
+        args = []
+
+        for part, offset in parts:
+            key = normalize(part)
+
+            e = self._elements.get(key)
+            if e is None:
+                try:
+                    e = ExpressionParser().parse(part)
+                except ParserException as ex:
+                    raise ParserException(ex.reason, None if ex.position is None else ex.position + offset)
+
+            elements[key] = e
+            args.append(e)
+
+        self._elements = elements
+        return expr.Expr_List(args)
+
+    def reset(self):
+        self._elements = {}
+
+
+def _splitList(text):
+    # top-level elements of a list and their offsets in text, None if text is not a (well formed) list
+    start = len(text) - len(text.lstrip())
+    end = len(text.rstrip())
+
+    if end - start < 2 or text[start] != u'{' or text[end - 1] != u'}':
+        return None
+
+    parts = []
+    depth = 0
+    begin = start + 1
+
+    for i in xrange(start + 1, end - 1):
+        c = text[i]
+
+        if c in u'({':
+            depth += 1
+        elif c in u')}':
+            depth -= 1
+            if depth < 0:
+                return None
+        elif c == u',' and depth == 0:
+            parts.append((text[begin:i], begin))
+            begin = i + 1
+
+    if depth != 0:
+        return None
+
+    # a trailing comma (or an empty list) is allowed
+    if text[begin:end - 1].strip():
+        parts.append((text[begin:end - 1], begin))
+
+    return parts
+
+
 def parse(text):
-    return ExpressionParser().parse(text)
+    key = normalize(text)
+
+    e = _expressionCache.get(key)
+    if e is None:
+        e = ExpressionParser().parse(text)
+        _expressionCache.put(key, e)
+
+    return e
 
 # TODO: this really belongs somewhere else
 def convert(expression):
@@ -280,6 +398,7 @@ def convert(expression):
     if e._header == 'List':
         if e.hasSymbol('dy/dt') and e.hasSymbol('dx/dt'):
             parts = {'dy/dt': None, 'dx/dt': None, 'x0': None, 'y0': None}
+            parameters = {}
 
             for x in e._args:
                 if x._header == '=':
@@ -291,10 +410,26 @@ def convert(expression):
                         parts['x0'] = x._args[1].value()
                     elif x._args[0].isSymbol() and (x._args[0].value() == 'y_0' or x._args[0].value() == 'y0'):
                         parts['y0'] = x._args[1].value()
+                    elif x._args[0].isSymbol() and x._args[1].isNumeric():
+                        # e.g. mu = 2
+                        parameters[x._args[0].value()] = x._args[1].value()
 
             if None not in parts.values():
-                system = ParsedSystem(parts['dx/dt'], parts['dy/dt'])
-                plot = OrbitPlot(system, QPointF(parts['x0'], parts['y0']))
+                key = (parts['dx/dt'].key(), parts['dy/dt'].key(), tuple(sorted(parameters.items())))
+
+                system = _systemCache.get(key)
+                if system is None:
+                    system = ParsedSystem(parts['dx/dt'], parts['dy/dt'], parameters)
+                    _systemCache.put(key, system)
+
+                # parameters may be changed on the system of a plot, it is not shared with the other plots
+                system = system.copy()
+
+                key = key + (parts['x0'], parts['y0'])
+                plot = OrbitPlot(system, QPointF(parts['x0'], parts['y0']), _solutionCache.get(key))
+                plot.solved.connect(lambda solution, values=system.parameters():
+                                    _cacheSolution(key, values, solution))
+
                 plot._formula = expression.formula()
                 return plot
             else:
@@ -1,6 +1,14 @@
 # encoding: utf-8
 
+import __future__
+import collections
+import copy
+import keyword
 import math
+import re
+import weakref
+
+import numpy
 
 
 class Expr(object):
@@ -9,6 +17,7 @@ class Expr(object):
         self._header = header
         self._attrs = 0
         self._args = [args] if type(args) != list else args
+        self._key = None
 
     def _checkArity(self, arity=1):
         if len(self._args) != arity:
@@ -48,6 +57,15 @@ class Expr(object):
 
         return self
 
+    def symbols(self):
+        if self.isNumeric():
+            return set()
+
+        if self.isSymbol():
+            return set([self.value()])
+
+        return set().union(*[x.symbols() for x in self._args])
+
     def hasSymbol(self, symbol, recursive=True):
         if not recursive:
             raise Exception('non recursive search not supported')
@@ -72,6 +90,55 @@ class Expr(object):
     def formula(self):
         return u'(Formula Unavailable)'
 
+    def key(self):
+        # hashable structural representation, two expressions are equal iff their keys are
+        if self._key is None:
+            if self.isNumeric() or self.isSymbol():
+                self._key = (self._header, self.value())
+            else:
+                self._key = (self._header,) + tuple(x.key() for x in self._args)
+
+        return self._key
+
+    def _rebuild(self, args):
+        e = copy.copy(self)
+        e._args = args
+        e._key = None
+        return e
+
+    def _source(self, names):
+        # shared subexpressions are replaced by the name of the variable holding their value
+        if names:
+            name = names.get(self.key())
+            if name is not None:
+                return name
+
+        return self._pySource(names)
+
+    def _pySource(self, names):
+        if self.isNumeric():
+            value = float(self.value())
+            # constants folded to infinity or nan have no literal
+            if math.isinf(value) or math.isnan(value):
+                return u"float('%r')" % value
+            return repr(value)
+
+        if self.isSymbol():
+            if not _IDENTIFIER.match(self.value()) or keyword.iskeyword(self.value()):
+                raise Exception(u'Symbol "%s" cannot be evaluated' % self.value())
+            return self.value()
+
+        raise Exception(u'Operator "%s" cannot be evaluated' % self._header)
+
+    def _diff(self, symbol):
+        if self.isNumeric():
+            return Expr(u'Number', 0.0)
+
+        if self.isSymbol():
+            return Expr(u'Number', 1.0 if self.value() == symbol else 0.0)
+
+        raise Exception(u'Operator "%s" cannot be differentiated' % self._header)
+
 
 class Expr_Plus(Expr):
     def __init__(self, args):
@@ -81,25 +148,58 @@ class Expr_Plus(Expr):
         args = self._flatten(self._simplifyArgs(subs))
 
         n = 0.0
-        newargs = []
+        terms = collections.OrderedDict() # like terms, c*e: key of e -> [e, c]
 
         for x in args:
             if x._header == 'Number':
                 n += x.value()
             else:
-                newargs.append(x)
+                c, e = _splitCoefficient(x)
+                terms.setdefault(e.key(), [e, 0.0])[1] += c
 
-        if newargs:
-            if n != 0.0:
-                return self.__class__([Expr(u'Number', n)] + newargs)
-            else:
-                return self.__class__(newargs)
-        else:
-            return Expr(u'Number', n)
+        newargs = []
+        for e, c in terms.values():
+            if c == 1.0:
+                newargs.append(e)
+            elif c != 0.0:
+                newargs.append(Expr_Mul([Expr(u'Number', c), e]).simplify())
+        newargs.sort(key=lambda x: x.key())
+
+        if n != 0.0 or not newargs:
+            newargs.insert(0, Expr(u'Number', n))
+
+        if len(newargs) == 1:
+            return newargs[0]
+        return self.__class__(newargs)
 
     def formula(self):
         return ' + '.join(self._args)
 
+    def _pySource(self, names):
+        # terms with a negative coefficient are subtracted, e.g. (x - y) rather than (x + (-1.0 * y))
+        plus, minus = [], []
+
+        for x in self._args:
+            if x.isNumeric():
+                c, e = x.value(), Expr(u'Number', 1.0)
+            else:
+                c, e = _splitCoefficient(x)
+
+            if c < 0.0:
+                minus.append(_scaled(-c, e)._source(names))
+            else:
+                plus.append(x._source(names))
+
+        if plus:
+            source = u' + '.join(plus)
+        else:
+            source = u'-' + minus.pop(0)
+
+        return u'(%s)' % u''.join([source] + [u' - ' + x for x in minus])
+
+    def _diff(self, symbol):
+        return Expr_Plus([x._diff(symbol) for x in self._args])
+
 
 class Expr_Mul(Expr):
     
@@ -110,21 +210,67 @@ class Expr_Mul(Expr):
         args = self._flatten(self._simplifyArgs(subs))
 
         n = 1.0
-        newargs = []
+        powers = collections.OrderedDict() # like factors, b^e: key of b -> [b, [e, ...]]
 
         for x in args:
+            if x._header == 'Number':
+                n *= x.value()
+            else:
+                b, e = _splitExponent(x)
+                powers.setdefault(b.key(), [b, []])[1].append(e)
+
+        newargs = []
+        for b, exponents in powers.values():
+            if len(exponents) == 1 and exponents[0].isNumeric() and exponents[0].value() == 1.0:
+                x = b
+            else:
+                x = Expr_Pow([b, Expr_Plus(exponents)]).simplify()
+
             if x._header == 'Number':
                 n *= x.value()
             else:
                 newargs.append(x)
+        newargs.sort(key=lambda x: x.key())
+
+        if n == 0.0:
+            return Expr(u'Number', 0.0)
 
-        if newargs:
-            if n != 1.0:
-                return self.__class__([Expr(u'Number', n)] + newargs)
+        if n != 1.0 or not newargs:
+            newargs.insert(0, Expr(u'Number', n))
+
+        if len(newargs) == 1:
+            return newargs[0]
+        return self.__class__(newargs)
+
+    def _pySource(self, names):
+        # factors with a negative exponent are compiled as a division
+        num, den = [], []
+
+        for x in self._args:
+            b, e = _splitExponent(x)
+            if e.isNumeric() and e.value() < 0.0:
+                den.append(b if e.value() == -1.0 else Expr_Pow([b, Expr(u'Number', -e.value())]))
             else:
-                return self.__class__(newargs)
-        else:
-            return Expr(u'Number', n)
+                num.append(x)
+
+        # a -1 coefficient is a negation
+        sign = u''
+        if num and num[0].isNumeric() and num[0].value() == -1.0 and len(num) > 1:
+            sign = u'-'
+            num = num[1:]
+
+        source = u' * '.join(x._source(names) for x in num) or u'1.0'
+        if den:
+            source = u'%s / (%s)' % (source, u' * '.join(x._source(names) for x in den))
+
+        return u'(%s%s)' % (sign, source)
+
+    def _diff(self, symbol):
+        # (f*g*...)' = f'*g*... + f*g'*... + ...
+        terms = []
+        for i, x in enumerate(self._args):
+            terms.append(Expr_Mul(self._args[:i] + [x._diff(symbol)] + self._args[i + 1:]))
+        return Expr_Plus(terms)
 
 
 class Expr_Div(Expr):
@@ -137,7 +283,7 @@ class Expr_Div(Expr):
         arg0, arg1 = self._simplifyArgs(subs)
 
         if arg1.isNumeric() and arg1.value() == 1.0:
-            return arg0.simplify()
+            return arg0
 
         if arg0.isNumeric() and arg0.value() == 0.0:
             return Expr(u'Number', 0.0)
@@ -149,7 +295,70 @@ class Expr_Div(Expr):
         if arg0.isSymbol() and arg1.isSymbol() and (arg0.value() == 'dx' or arg0.value() == 'dy') and arg1.value() == 'dt':
             return Expr(u'Symbol', u'%s/%s' % (arg0.value(), arg1.value()))
 
-        return self
+        # canonical form is f * g^-1, so that factors (and coefficients) can be combined with others
+        return Expr_Mul([arg0, Expr_Pow([arg1, Expr(u'Number', -1.0)])]).simplify()
+
+    def _pySource(self, names):
+        return u'(%s / %s)' % (self._args[0]._source(names), self._args[1]._source(names))
+
+    def _diff(self, symbol):
+        # (f/g)' = (f'*g - f*g') / g^2
+        f, g = self._args
+        return Expr_Div([Expr_Plus([Expr_Mul([f._diff(symbol), g]),
+                                    Expr_Mul([Expr(u'Number', -1.0), f, g._diff(symbol)])]),
+                         Expr_Pow([g, Expr(u'Number', 2.0)])])
+
+
+class Expr_Pow(Expr):
+
+    def __init__(self, args):
+        super(Expr_Pow, self).__init__(u'^', args)
+        self._checkArity(2)
+
+    def simplify(self, subs={}):
+        arg0, arg1 = self._simplifyArgs(subs)
+
+        if arg1.isNumeric() and arg1.value() == 1.0:
+            return arg0
+
+        if arg1.isNumeric() and arg1.value() == 0.0:
+            return Expr(u'Number', 1.0)
+
+        if arg0.isNumeric() and arg1.isNumeric():
+            return Expr(u'Number', arg0.value() ** arg1.value())
+
+        if arg0.isNumeric() and arg0.value() == 1.0:
+            return Expr(u'Number', 1.0)
+
+        # (b^e)^n = b^(e*n) for integer n
+        if arg0._header == u'^' and arg1.isNumeric() and arg1.value() == int(arg1.value()):
+            return Expr_Pow([arg0._args[0], Expr_Mul([arg0._args[1], arg1])]).simplify()
+
+        return self.__class__([arg0, arg1])
+
+    def _pySource(self, names):
+        base, exponent = self._args[0]._source(names), self._args[1]
+
+        if exponent.isNumeric() and exponent.value() < 0.0:
+            inverse = self._args[0] if exponent.value() == -1.0 else Expr_Pow([self._args[0], Expr(u'Number', -exponent.value())])
+            return u'(1.0 / %s)' % inverse._source(names)
+
+        # small integer powers of a variable are cheaper as products (x*x is about twice as fast as x ** 2.0)
+        if _IDENTIFIER.match(base) and exponent.isNumeric() and exponent.value() in (2.0, 3.0, 4.0):
+            return u'(%s)' % u' * '.join([base] * int(exponent.value()))
+
+        return u'(%s ** %s)' % (base, exponent._source(names))
+
+    def _diff(self, symbol):
+        f, g = self._args
+
+        if g.hasSymbol(symbol):
+            # (f^g)' = f^g * (g' * log(f) + g * f' / f)
+            return Expr_Mul([self, Expr_Plus([Expr_Mul([g._diff(symbol), Expr_NumericFunction('log', f)]),
+                                              Expr_Mul([g, f._diff(symbol), Expr_Pow([f, Expr(u'Number', -1.0)])])])])
+
+        # (f^c)' = c * f^(c-1) * f'
+        return Expr_Mul([g, Expr_Pow([f, Expr_Plus([g, Expr(u'Number', -1.0)])]), f._diff(symbol)])
 
 
 class Expr_List(Expr):
@@ -173,30 +382,260 @@ class Expr_List(Expr):
         return f
 
 
+def _number(value):
+    return Expr(u'Number', value)
+
+
+def _fn(fname, *args):
+    return Expr_NumericFunction(fname, list(args))
+
+
 class Expr_NumericFunction(Expr):
 
     ALLOWED_FUNCTIONS = {
         'sin': math.sin,    
-        'cos': math.cos
+        'cos': math.cos,
+        'tan': math.tan,
+        'asin': math.asin,
+        'acos': math.acos,
+        'atan': math.atan,
+        'atan2': math.atan2,
+        'sinh': math.sinh,
+        'cosh': math.cosh,
+        'tanh': math.tanh,
+        'exp': math.exp,
+        'log': math.log,
+        'sqrt': math.sqrt,
+        'abs': math.fabs,
+        'pow': math.pow
     }
 
-    def __init__(self, fname, arg):
-        super(Expr_NumericFunction, self).__init__(u'NumericFunction', [arg])
+    # ufunc counterparts of ALLOWED_FUNCTIONS, used for vectorized evaluation
+    NUMPY_FUNCTIONS = {
+        'sin': numpy.sin,
+        'cos': numpy.cos,
+        'tan': numpy.tan,
+        'asin': numpy.arcsin,
+        'acos': numpy.arccos,
+        'atan': numpy.arctan,
+        'atan2': numpy.arctan2,
+        'sinh': numpy.sinh,
+        'cosh': numpy.cosh,
+        'tanh': numpy.tanh,
+        'exp': numpy.exp,
+        'log': numpy.log,
+        'sqrt': numpy.sqrt,
+        'abs': numpy.fabs,
+        'pow': numpy.power
+    }
+
+    # number of arguments, when it is not 1
+    ARITY = {
+        'atan2': 2,
+        'pow': 2
+    }
+
+    # partial derivatives of each function with respect to each of its arguments, as expressions of the arguments
+    DERIVATIVES = {
+        'sin': lambda u: [_fn('cos', u)],
+        'cos': lambda u: [Expr_Mul([_number(-1.0), _fn('sin', u)])],
+        'tan': lambda u: [Expr_Plus([_number(1.0), Expr_Pow([_fn('tan', u), _number(2.0)])])],
+        'asin': lambda u: [Expr_Pow([Expr_Plus([_number(1.0), Expr_Mul([_number(-1.0), Expr_Pow([u, _number(2.0)])])]),
+                                     _number(-0.5)])],
+        'acos': lambda u: [Expr_Mul([_number(-1.0),
+                                     Expr_Pow([Expr_Plus([_number(1.0), Expr_Mul([_number(-1.0), Expr_Pow([u, _number(2.0)])])]),
+                                               _number(-0.5)])])],
+        'atan': lambda u: [Expr_Pow([Expr_Plus([_number(1.0), Expr_Pow([u, _number(2.0)])]), _number(-1.0)])],
+        'atan2': lambda v, u: [Expr_Div([u, Expr_Plus([Expr_Pow([u, _number(2.0)]), Expr_Pow([v, _number(2.0)])])]),
+                               Expr_Div([Expr_Mul([_number(-1.0), v]),
+                                         Expr_Plus([Expr_Pow([u, _number(2.0)]), Expr_Pow([v, _number(2.0)])])])],
+        'sinh': lambda u: [_fn('cosh', u)],
+        'cosh': lambda u: [_fn('sinh', u)],
+        'tanh': lambda u: [Expr_Plus([_number(1.0), Expr_Mul([_number(-1.0), Expr_Pow([_fn('tanh', u), _number(2.0)])])])],
+        'exp': lambda u: [_fn('exp', u)],
+        'log': lambda u: [Expr_Pow([u, _number(-1.0)])],
+        'sqrt': lambda u: [Expr_Mul([_number(0.5), Expr_Pow([_fn('sqrt', u), _number(-1.0)])])],
+        'abs': lambda u: [Expr_Div([u, _fn('abs', u)])],
+        'pow': lambda u, v: [Expr_Mul([v, Expr_Pow([u, Expr_Plus([v, _number(-1.0)])])]),
+                             Expr_Mul([_fn('pow', u, v), _fn('log', u)])]
+    }
+
+    def __init__(self, fname, args):
+        super(Expr_NumericFunction, self).__init__(u'NumericFunction', args)
         
         if fname not in Expr_NumericFunction.ALLOWED_FUNCTIONS:
             raise Exception(u'Function "%s" is unknown' % fname)
 
-        self._checkArity(1) 
+        arity = Expr_NumericFunction.ARITY.get(fname, 1)
+        if len(self._args) != arity:
+            raise Exception(u'Function "%s" takes %d argument(s), received %d' % (fname, arity, len(self._args)))
 
         self._fname = fname
+        # resolved once, so that evaluating the node needs no lookup by name
+        self._function = Expr_NumericFunction.ALLOWED_FUNCTIONS[fname]
+        self._ufunc = Expr_NumericFunction.NUMPY_FUNCTIONS[fname]
 
     def simplify(self, subs={}):
-        arg0, = self._simplifyArgs(subs)
+        args = self._simplifyArgs(subs)
 
-        if arg0.isNumeric():
-            return Expr(u'Number', Expr_NumericFunction.ALLOWED_FUNCTIONS[self._fname](arg0.value()))
+        if all(x.isNumeric() for x in args):
+            return Expr(u'Number', self._function(*[x.value() for x in args]))
 
-        return self
+        return self.__class__(self._fname, args)
+
+    def key(self):
+        if self._key is None:
+            self._key = (self._header, self._fname) + tuple(x.key() for x in self._args)
+        return self._key
+
+    def _pySource(self, names):
+        return u'_%s(%s)' % (self._fname, u', '.join(x._source(names) for x in self._args))
+
+    def _diff(self, symbol):
+        # chain rule
+        partials = Expr_NumericFunction.DERIVATIVES[self._fname](*self._args)
+        return Expr_Plus([Expr_Mul([d, x._diff(symbol)]) for d, x in zip(partials, self._args)])
 
     def __repr__(self):
-        return '%s(%s)' % (self._fname, self._args)
\ No newline at end of file
+        return '%s(%s)' % (self._fname, self._args)
+
+
+_IDENTIFIER = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+
+def lambdify(exprs, symbols=(u'x', u'y', u't'), module='math', parameters=None):
+    # compiles exprs into a Python function of symbols (and of the parameter values, if given), with the
+    # structure of exprs; shared subexpressions are evaluated once per call, module='numpy' works on arrays
+    if module == 'math':
+        functions = Expr_NumericFunction.ALLOWED_FUNCTIONS
+    elif module == 'numpy':
+        functions = Expr_NumericFunction.NUMPY_FUNCTIONS
+    else:
+        raise Exception(u'Unknown module "%s"' % module)
+
+    unknown = _symbols(exprs) - set(symbols) - set(parameters or ())
+    if unknown:
+        raise Exception(u'Unknown symbol(s): %s' % u', '.join(sorted(unknown)))
+
+    # functions are bound as default arguments, so calling them is a local (not a global) lookup
+    functionNames = sorted(_functionNames(exprs))
+    arguments = list(symbols) + ([u'_p'] if parameters is not None else [])
+    arguments += [u'_%s=_%s' % (name, name) for name in functionNames]
+
+    lines = [u'def _compiled(%s):' % u', '.join(arguments)]
+
+    if parameters:
+        lines.append(u'    %s, = _p' % u', '.join(parameters))
+
+    # every subexpression used more than once is computed once, into a local variable
+    names = {}
+
+    for e in _sharedSubexpressions(exprs):
+        source = e._source(names)
+        names[e.key()] = u'_c%d' % len(names)
+        lines.append(u'    %s = %s' % (names[e.key()], source))
+
+    lines.append(u'    return %s' % _tupleSource(exprs, names))
+    source = u'\n'.join(lines) + u'\n'
+
+    namespace = dict((u'_%s' % name, functions[name]) for name in functionNames)
+    code = compile(source, '<dynamite>', 'exec', __future__.division.compiler_flag, True)
+    exec(code, namespace)
+
+    return namespace['_compiled']
+
+
+def _splitCoefficient(e):
+    # c*e -> (c, e), for simplified expressions (where the numeric factor comes first)
+    if e._header == u'*' and e._args[0].isNumeric():
+        rest = e._args[1:]
+        return e._args[0].value(), rest[0] if len(rest) == 1 else Expr_Mul(rest)
+    return 1.0, e
+
+
+def _scaled(c, e):
+    # c*e, without a unit coefficient
+    if e.isNumeric():
+        return Expr(u'Number', c * e.value())
+    if c == 1.0:
+        return e
+    return Expr_Mul([Expr(u'Number', c), e])
+
+
+def _splitExponent(e):
+    # b^e -> (b, e)
+    if e._header == u'^':
+        return e._args[0], e._args[1]
+    return e, Expr(u'Number', 1.0)
+
+
+def _symbols(exprs):
+    if isinstance(exprs, Expr):
+        return exprs.symbols()
+    return set().union(*[_symbols(e) for e in exprs])
+
+
+def _functionNames(exprs):
+    if isinstance(exprs, Expr):
+        names = set([exprs._fname]) if isinstance(exprs, Expr_NumericFunction) else set()
+        if not (exprs.isNumeric() or exprs.isSymbol()):
+            names.update(_functionNames(exprs._args))
+        return names
+    return set().union(*[_functionNames(e) for e in exprs])
+
+
+def _tupleSource(exprs, names):
+    if isinstance(exprs, Expr):
+        return exprs._source(names)
+    return u'(%s,)' % u', '.join(_tupleSource(e, names) for e in exprs)
+
+
+def _sharedSubexpressions(exprs):
+    # (non-leaf) subexpressions referenced more than once, each one after the subexpressions it contains
+    counts = {}
+    order = []
+
+    def visit(e):
+        if isinstance(e, Expr):
+            if e.isNumeric() or e.isSymbol():
+                return
+
+            key = e.key()
+            if key in counts:
+                counts[key] += 1
+                return
+
+            counts[key] = 1
+            for x in e._args:
+                visit(x)
+            order.append(e)
+        else:
+            for x in e:
+                visit(x)
+
+    visit(exprs)
+    return [e for e in order if counts[e.key()] > 1]
+
+
+_INTERNED = weakref.WeakValueDictionary()
+
+
+def share(expr):
+    # hash-consing: structurally equal subexpressions (also of previously shared expressions) become the same object
+    key = expr.key()
+
+    e = _INTERNED.get(key)
+    if e is not None:
+        return e
+
+    if not (expr.isNumeric() or expr.isSymbol()):
+        expr = expr._rebuild([share(x) for x in expr._args])
+        expr._key = key
+
+    _INTERNED[key] = expr
+    return expr
+
+
+def diff(expr, symbol):
+    # (simplified) derivative of expr with respect to symbol
+    return expr._diff(symbol).simplify()
@@ -2,46 +2,209 @@
 
 import math
 
+import numpy
+
 from PySide.QtCore import *
 from PySide.QtGui import *
 
 from dynamite.plots import DynamitePlot
-from dynamite.core.integrators import RungeKutta4
+from dynamite.utils import LRUCache
+from dynamite.core.analysis import findCycle
+from dynamite.core.events import BoundingBox, MinimumSpeed
+from dynamite.core.integrators import RungeKutta4, Solution
+from dynamite.core.workers import solveAsync
 
 
 class OrbitPlot(DynamitePlot):
+
+    # integration step and number of steps solved at once, in each direction
+    H = 0.05
+    STEPS = 400
+    # the orbit is not extended beyond this number of points
+    MAX_POINTS = 40000
+    # the orbit ends when it settles on a fixed point or escapes this far
+    MIN_SPEED = 1e-6
+    ESCAPE = 1e8
+    # pixels around the view where the orbit is still drawn (lines have a width)
+    MARGIN = 8.0
+
+    # emitted when the orbit has been solved further
+    solved = Signal(object)
+
+    # the pool delivers results in one of its threads, this signal brings them to the thread of the plot
+    _solutionReady = Signal(object)
     
-    def __init__(self, system, point):
+    def __init__(self, system, point, solution=None):
         super(OrbitPlot, self).__init__()
         self._system = system
         self._initialPoint = point
-        self._data = []
+        self._events = (MinimumSpeed(system, self.MIN_SPEED),
+                        BoundingBox(-self.ESCAPE, -self.ESCAPE, self.ESCAPE, self.ESCAPE))
+
+        if solution is None:
+            self._data = Solution(system)
+            self._data.append(0.0, point.x(), point.y())
+        else:
+            # the solution is extended in place, so it is not shared with other plots
+            self._data = solution.copy(system)
+
+        # requests in flight for each direction: 1 (forward), -1 (backward)
+        self._pending = {1: False, -1: False}
+        self._period = (self._data.cycle(1) or self._data.cycle(-1) or (None, None))[1]
 
         self.priority = 10
 
-        self._solve()
+        self._solutionReady.connect(self._setSolution)
+
+        if len(self._data) < 2:
+            self._solve()
+        else:
+            self._closeCycle(1)
+            self._closeCycle(-1)
 
     def _solve(self):
-        # solve the PVI
-        self._data = RungeKutta4.solve(self._system, self._initialPoint.x(), self._initialPoint.y(), 0.0, 400)
+        # solve the PVI forward and backward in time, in the background
+        self._extend(1)
+        self._extend(-1)
+
+    def _extend(self, direction):
+        # integrates STEPS more steps from the forward (or backward) end of the orbit
+        if self._pending[direction] or self._data.finished(direction):
+            return
+
+        t, x, y = self._data.last() if direction > 0 else self._data.first()
+        self._pending[direction] = True
+
+        solveAsync(RungeKutta4, (self._system, x, y, t, self.STEPS, direction * self.H, self._events),
+                   lambda solution: self._solutionReady.emit((direction, solution)))
+
+    def _setSolution(self, result):
+        direction, solution = result
+        self._pending[direction] = False
+
+        if self._data.finished(direction):
+            # the orbit was closed while this was being solved
+            return
+
+        if isinstance(solution, Exception):
+            print 'SolveError:', solution
+            self._data.setFinished(direction)
+            return
+
+        # the first row is the end we started from
+        rows = solution.data()[1:]
+        finite = numpy.isfinite(rows).all(axis=1)
+        if not finite.all():
+            rows = rows[:numpy.argmin(finite)]
+            self._data.setFinished(direction)
+
+        if direction > 0:
+            self._data.extend(rows)
+        else:
+            self._data.prepend(rows[::-1])
+
+        for event in solution.events():
+            self._data.addEvent(*event)
+            if event[3].terminal:
+                self._data.setFinished(direction)
+
+        self._closeCycle(direction)
+
+        self.solved.emit(self._data)
+        self.plotChanged.emit()
+
+    def _closeCycle(self, direction):
+        # an orbit that settled on a cycle would only retrace it, it is cut after the first turn that closes and is not
+        # extended anymore
+        # a forced system coming back to a point is not periodic unless the forcing is in the same phase again
+        if self._data.finished(direction) or not self._system.isAutonomous():
+            return
+
+        # the initial point is at t = 0, each direction is searched on its own side
+        cycle = self._data.cycle(direction) or findCycle(self._data, direction, since=0.0)
+        if cycle is None:
+            return
+
+        self._data.setCycle(direction, *cycle)
+
+        t, self._period = cycle
+        times = self._data.times()
+
+        if direction > 0:
+            self._data.truncate(0, numpy.searchsorted(times, t) + 1)
+        else:
+            self._data.truncate(numpy.searchsorted(times, t, side='right') - 1, len(times))
+
+        self._data.setFinished(direction)
+
+        # the orbit reached the cycle in its first turn, the other direction would go around it again
+        if abs(t) < 2.0 * self._period:
+            times = self._data.times()
+            if direction > 0:
+                self._data.truncate(numpy.searchsorted(times, 0.0), len(times))
+            else:
+                self._data.truncate(0, numpy.searchsorted(times, 0.0, side='right'))
+
+            self._data.setFinished(-direction)
+
+        # truncate() keeps the buffer, the memory of the dropped turns is released here
+        self._data.trim()
+
+    def _extendToView(self, transform):
+        # an end of the orbit inside the view means the orbit could continue on screen
+        if len(self._data) >= self.MAX_POINTS:
+            return
+
+        x0, y0 = transform.view[0].x(), transform.view[0].y()
+        x1, y1 = transform.view[1].x(), transform.view[1].y()
+
+        for direction, (t, x, y) in ((1, self._data.last()), (-1, self._data.first())):
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                self._extend(direction)
 
     def paint(self, painter, transform):
-        path = QPainterPath()
+        self._extendToView(transform)
+
+        if len(self._data) < 2:
+            # not solved yet, mark the initial point
+            painter.drawEllipse(transform.pointToPixel(self._initialPoint), 3.0, 3.0)
+            return
 
-        ppixel = transform.pointToPixel(self._data[0])
-        for point in self._data:
-            pixel = transform.pointToPixel(point)
+        ts, runs = self._visibleTimes(transform)
+        if len(ts) < 2:
+            return
 
-            path.moveTo(ppixel)
-            path.lineTo(pixel)
+        xs, ys = self._data.sample(ts)
+        px, py = transform.pointsToPixels(xs, ys)
 
-            ppixel = pixel
+        m = self.MARGIN
+        for x, y in _clipPolyline(px, py, runs, -m, -m, transform.width + m, transform.height + m):
+            painter.drawPolyline(QPolygonF(map(QPointF, x.tolist(), y.tolist())))
 
-        painter.drawPath(path)
+    def _visibleTimes(self, transform):
+        # times to sample the dense output at (about) 2 pixels per segment, only for the steps that may reach the view,
+        # and the run (of consecutive steps) every time belongs to
+        points = self._data.points()
+        px, py = transform.pointsToPixels(points[:, 0], points[:, 1])
+
+        # the curve of a step stays within about its own length of its chord
+        m = self.MARGIN + numpy.hypot(numpy.diff(px), numpy.diff(py))
+        near = ((numpy.maximum(px[:-1], px[1:]) >= -m) & (numpy.minimum(px[:-1], px[1:]) <= transform.width + m) &
+                (numpy.maximum(py[:-1], py[1:]) >= -m) & (numpy.minimum(py[:-1], py[1:]) <= transform.height + m))
+
+        sx, sy = transform.scale()
+        return self._data.refinedTimes(2.0, sx, sy, steps=numpy.nonzero(near)[0])
 
     def initialPoint(self):
         return self._initialPoint
 
+    def solution(self):
+        return self._data
+
+    def period(self):
+        # period of the cycle the orbit settled on, None if it is not periodic (as far as it was integrated)
+        return self._period
+
     def __str__(self):
         return '(x,y) = (%0.2lf, %0.2lf)' % (self._initialPoint.x(), self._initialPoint.y())
 
@@ -49,6 +212,37 @@ class OrbitPlot(DynamitePlot):
     #     return u'{dx/dt = %s, dy/dt = %s, x0 = %s, y0 = %s}' % (self._system.formula(), )
 
 
+def _clipPolyline(xs, ys, runs, x0, y0, x1, y1):
+    # Liang-Barsky clipping of the segments between consecutive points of the same run to [x0, x1] × [y0, y1],
+    # returns the visible parts as a list of (xs, ys) polylines
+    ax, ay = xs[:-1], ys[:-1]
+    dx, dy = numpy.diff(xs), numpy.diff(ys)
+
+    t0, t1 = numpy.zeros(len(dx)), numpy.ones(len(dx))
+    visible = runs[:-1] == runs[1:]
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, ax - x0), (dx, x1 - ax), (-dy, ay - y0), (dy, y1 - ay)):
+            r = q / p
+            visible &= (p != 0.0) | (q >= 0.0)
+            t0 = numpy.where(p < 0.0, numpy.maximum(t0, r), t0)
+            t1 = numpy.where(p > 0.0, numpy.minimum(t1, r), t1)
+
+    s = numpy.nonzero(visible & (t0 <= t1))[0]
+    if len(s) == 0:
+        return []
+
+    cx0, cy0 = ax[s] + t0[s] * dx[s], ay[s] + t0[s] * dy[s]
+    cx1, cy1 = ax[s] + t1[s] * dx[s], ay[s] + t1[s] * dy[s]
+
+    # a polyline goes on while the next segment is visible too and neither is cut where they meet
+    joined = (s[1:] == s[:-1] + 1) & (t1[s[:-1]] >= 1.0) & (t0[s[1:]] <= 0.0)
+    breaks = numpy.nonzero(~joined)[0] + 1
+
+    return [(numpy.append(cx0[a], cx1[a:b]), numpy.append(cy0[a], cy1[a:b]))
+            for a, b in zip(numpy.append(0, breaks), numpy.append(breaks, len(s)))]
+
+
 class SlopeField(DynamitePlot):
 
     def __init__(self, system):
@@ -61,34 +255,53 @@ class SlopeField(DynamitePlot):
 
         self.priority = 5
 
-    def paint(self, painter, transform):
-        xstep = transform.width / self.settings['density']
-        ystep = transform.height / self.settings['density']
+        # geometry of the last few views, repaints that don't change the view, the size or the density reuse it
+        self._cache = LRUCache(4)
+
+    def invalidate(self):
+        # the field must be computed again (e.g. parameters of the system changed)
+        self._cache.invalidate()
+
+    def _segments(self, transform):
+        # pixel coordinates (x0, y0, x1, y1) of the segment of every cell, computed for the whole grid at once
+        density = self.settings['density']
+        xstep = transform.width / density
+        ystep = transform.height / density
 
-        p1 = transform.pixelToPoint(xstep, ystep)
-        p2 = transform.pixelToPoint(2 * xstep, 2 * ystep)
-        a = p2.x() - p1.x()
-        b = p2.y() - p1.y()
+        n = numpy.arange(1, int(math.floor(density)) + 1)
+        px, py = numpy.meshgrid(n * xstep, n * ystep)
+        xs, ys = transform.pixelsToPoints(px.ravel(), py.ravel())
 
-        N = math.sqrt(a*a + b*b)
+        # segments are a quarter of the cell diagonal long, in view units
+        sx, sy = transform.scale()
+        N = math.hypot(xstep / sx, ystep / sy)
 
-        x = xstep
-        while (x <= transform.width):
-            y = ystep # reset y
+        with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            L, M = self._system.evaluateMany(xs, ys, 0.0)
+            k = N / (4.0 * numpy.hypot(L, M))
+            dx, dy = L * k, M * k
 
-            while (y <= transform.height):
-                point = transform.pixelToPoint(x, y)
-                L, M = self._system.evaluate(point.x(), point.y(), 0.0)
-                Mod = 4.0 * math.sqrt(L*L + M*M)
+        # no segment (just the point) where the field vanishes or is undefined
+        undefined = ~(numpy.isfinite(dx) & numpy.isfinite(dy))
+        dx[undefined] = dy[undefined] = 0.0
+
+        x1, y1 = transform.pointsToPixels(xs + dx, ys + dy)
+        return px.ravel(), py.ravel(), x1, y1
+
+    def paint(self, painter, transform):
+        view = transform.view
+        key = (view[0].x(), view[0].y(), view[1].x(), view[1].y(), transform.width, transform.height,
+               self.settings['density'], id(self._system), tuple(sorted(self._system.parameters().items())))
 
-                q1 = transform.pointToPixel(point.x() + L * N/Mod, point.y() + M * N / Mod)
-                q2 = transform.pointToPixel(point.x(), point.y())
+        geometry = self._cache.get(key)
+        if geometry is None:
+            x0, y0, x1, y1 = [a.tolist() for a in self._segments(transform)]
+            geometry = (map(QLineF, x0, y0, x1, y1), QPolygonF(map(QPointF, x0, y0)))
+            self._cache.put(key, geometry)
 
-                painter.drawLine(q2.x(), q2.y(), q1.x(), q1.y())
-                painter.drawPoint(q2)
+        lines, points = geometry
+        painter.drawLines(lines)
+        painter.drawPoints(points)
 
-                y = y + ystep
-            x = x + xstep
-        
     def getName(self):
         return '%s slope field' % self._system.getName()
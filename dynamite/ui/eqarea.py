@@ -3,7 +3,7 @@
 from PySide.QtCore import *
 from PySide.QtGui import *
 
-from dynamite.parser import convert, parse
+from dynamite.parser import convert, parse, IncrementalParser
 
 
 class EquationArea(QTextEdit):
@@ -15,6 +15,9 @@ class EquationArea(QTextEdit):
 
     formulaDone = Signal(unicode, object, object)
 
+    # delay (in ms) after the last keystroke before the formula is checked
+    PREVIEW_DELAY = 250
+
 
     def __init__(self, *args, **kwargs):
         super(EquationArea, self).__init__(*args, **kwargs)
@@ -29,6 +32,14 @@ class EquationArea(QTextEdit):
         self._formula = None
         self._state = EquationArea.State.SINGLE
 
+        self._parser = IncrementalParser()
+
+        self._previewTimer = QTimer(self)
+        self._previewTimer.setSingleShot(True)
+        self._previewTimer.setInterval(self.PREVIEW_DELAY)
+        self._previewTimer.timeout.connect(self._previewFormula)
+        self.textChanged.connect(self._previewTimer.start)
+
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Return:
             self._validateFormula()
@@ -56,6 +67,8 @@ class EquationArea(QTextEdit):
             raise Exception('Invalid EquationArea state')
 
     def setFormula(self, text):
+        self._parser.reset()
+        self._markError(None)
         self.setPlainText(text)
 
     def _validateFormula(self):
@@ -65,6 +78,8 @@ class EquationArea(QTextEdit):
         text = self.toPlainText()
         expression = obj = None
 
+        self._previewTimer.stop()
+
         try:
             expression = parse(text)
             obj = convert(expression)
@@ -74,6 +89,28 @@ class EquationArea(QTextEdit):
 
         self.formulaDone.emit(text, expression, obj)
 
+    def _previewFormula(self):
+        text = self.toPlainText()
+
+        # nothing typed yet is not an error
+        if self.state == EquationArea.State.MULTIPLE or not text.strip():
+            self._markError(None)
+            return
+
+        # only marks the errors, the formula is used on Return
+        try:
+            self._parser.parse(text)
+            self._markError(None)
+        except Exception as e:
+            self._markError(unicode(e))
+
+    def _markError(self, message):
+        if message is None:
+            self.setStyleSheet(u'')
+            self.setToolTip(u'')
+        else:
+            self.setStyleSheet(u'background-color: #fff0f0;')
+            self.setToolTip(message)
 
 
     def _processFormula(self):
@@ -43,7 +43,7 @@ class ColorButton(QWidget):
 
         self.colorChanged.emit(color)
 
-        self.repaint()
+        self.update()
 
     def getColor(self):
         return self._color
@@ -1,5 +1,7 @@
 # encoding: utf-8
 
+import collections
+
 
 class WithSettings(object):
     
@@ -18,4 +20,40 @@ class WithSettings(object):
 
     def resetSettings(self):
         if hasattr(self, '_settings'):
-            self._settings['current'] = self._settings['defaults']
\ No newline at end of file
+            self._settings['current'] = self._settings['defaults']
+
+
+class LRUCache(object):
+    # mapping with a bounded size, the least recently used entries are evicted
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -45,6 +45,9 @@ class DynamiteView(QWidget):
         self.setFocusPolicy(Qt.ClickFocus)
 
 
+        # every plot is painted into its own image, which is kept until the plot or the view changes
+        self._layers = {}
+
         self._plots = []
         self.add(CoordinateAxesPlot())
 
@@ -55,8 +58,9 @@ class DynamiteView(QWidget):
     @view.setter
     def view(self, view):
         self._view = list(view)
+        self._invalidateLayers()
         self.viewChanged.emit()
-        self.repaint()
+        self.update()
 
     def focusInEvent(self, event):
         super(DynamiteView, self).focusInEvent(event)
@@ -66,35 +70,54 @@ class DynamiteView(QWidget):
     def resizeEvent(self, event):
         self._width = event.size().width()
         self._height = event.size().height()
+        self._invalidateLayers()
         super(DynamiteView, self).resizeEvent(event)
 
+    def _invalidateLayers(self, plot=None):
+        if plot is None:
+            self._layers.clear()
+        else:
+            self._layers.pop(plot, None)
+
+    def _layer(self, plot, transform):
+        image = self._layers.get(plot)
+
+        if image is None:
+            image = QImage(self._width, self._height, QImage.Format_ARGB32_Premultiplied)
+            image.fill(0) # transparent
+
+            p = QPainter(image)
+            p.setRenderHint(QPainter.Antialiasing, True)
+
+            pen = QPen()
+            pen.setColor(QColor(plot.settings['color']))
+            pen.setWidth(plot.settings['line-width'])
+            p.setPen(pen)
+
+            plot.paint(p, transform)
+            p.end()
+
+            self._layers[plot] = image
+
+        return image
+
     # paint event
     def paintEvent(self, event):
         p = QPainter(self)
         p.fillRect(QRectF(0, 0, self._width, self._height), Qt.white)
 
-        p.setRenderHint(QPainter.Antialiasing, True)            
-
         selectedPlots = self.selectedPlots()
 
-        # plots are painted according to their priority
+        # plots are composited according to their priority, only the layers of plots that changed are painted again
         coordTransform = CoordinateTransform(self._view, self._width, self._height)
         for i, plot in enumerate(sorted(self._plots, key=lambda x : x.priority)):
             if plot.enabled:
-                    p.save()
-
-                    pen = QPen()
-                    color = QColor(plot.settings['color'])
-                    
-                    if selectedPlots and plot not in selectedPlots and i != 0:
-                        color.setAlphaF(0.5)
+                if selectedPlots and plot not in selectedPlots and i != 0:
+                    p.setOpacity(0.5)
+                else:
+                    p.setOpacity(1.0)
 
-                    pen.setColor(color)
-                    pen.setWidth(plot.settings['line-width'])
-                    p.setPen(pen)
-
-                    plot.paint(p, coordTransform)
-                    p.restore()
+                p.drawImage(0, 0, self._layer(plot, coordTransform))
 
 
         if self.hasFocus():
@@ -124,12 +147,17 @@ class DynamiteView(QWidget):
         if plot not in self._plots:
             self._plots.append(plot)
             plot.plotSelectionChanged.connect(self._selectionChanged)
-            plot.plotChanged.connect(self.repaint)
+            plot.plotChanged.connect(self._plotChanged)
             
             self.plotAdded.emit(plot)
 
         self.viewChanged.emit()
-        self.repaint()
+        self.update()
+
+    def _plotChanged(self):
+        # update() only schedules a paint event, all the changes until it is delivered are painted at once
+        self._invalidateLayers(self.sender())
+        self.update()
 
     def _selectionChanged(self):
         if self.sender() != self._plots[0]:
@@ -138,15 +166,16 @@ class DynamiteView(QWidget):
             self.selectionChanged.emit([], [x for x in self._plots if not x.selected and x != self._plots[0]])
         
         self.viewChanged.emit()
-        self.repaint()
+        self.update()
 
     def remove(self, plot):
         if plot in self._plots:
             self._plots.remove(plot)
+            self._invalidateLayers(plot)
             self.plotRemoved.emit(plot)
 
             self.viewChanged.emit()
-            self.repaint()
+            self.update()
 
             return plot
         return None
@@ -171,7 +200,8 @@ class DynamiteView(QWidget):
         self._view[0].setY(viewCenterY - viewHeight / 2.0)
         self._view[1].setY(viewCenterY + (viewHeight / 2.0))
 
-        self.repaint()
+        self._invalidateLayers()
+        self.update()
 
 
 class CoordinateTransform(object):
@@ -191,6 +221,23 @@ class CoordinateTransform(object):
         y = self.height - ((qpoint.y() - self.view[0].y()) * (self.height / (self.view[1].y() - self.view[0].y()) ))
         return QPointF(x, y)
 
+    def pointsToPixels(self, xs, ys):
+        # vectorized pointToPixel(), for numpy arrays of coordinates
+        x = (xs - self.view[0].x()) * ( self.width / (self.view[1].x() - self.view[0].x()) )
+        y = self.height - ((ys - self.view[0].y()) * (self.height / (self.view[1].y() - self.view[0].y()) ))
+        return x, y
+
+    def pixelsToPoints(self, xs, ys):
+        # inverse of pointsToPixels()
+        x = self.view[0].x() + xs * ( (self.view[1].x() - self.view[0].x()) / self.width )
+        y = self.view[1].y() - ys * ( (self.view[1].y() - self.view[0].y()) / self.height )
+        return x, y
+
+    def scale(self):
+        # pixels per unit on each axis
+        return (self.width / (self.view[1].x() - self.view[0].x()),
+                self.height / (self.view[1].y() - self.view[0].y()))
+
     def pixelToPoint(self, *args):
         if len(args) >= 2:
             return self.pixelToPoint(QPointF(args[0], args[1]))
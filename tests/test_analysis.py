@@ -0,0 +1,29 @@
+# encoding: utf-8
+
+import math
+import unittest
+
+from dynamite.core import ParsedSystem
+from dynamite.core.analysis import findCycle
+from dynamite.core.integrators import RungeKutta4
+from dynamite.parser import parse
+
+
+class FindCycleTest(unittest.TestCase):
+
+    def test_loop_after_transient(self):
+        # spirals out from near the origin onto the unit circle, the orbit up to the cycle time holds a full loop of it
+        system = ParsedSystem(parse(u'-y + x*(1 - x^2 - y^2)'), parse(u'x + y*(1 - x^2 - y^2)'))
+        solution = RungeKutta4.solve(system, 0.1, 0.0, 0.0, 600)
+
+        t, period = findCycle(solution)
+
+        self.assertAlmostEqual(period, 2 * math.pi, places=3)
+        self.assertLessEqual(t, solution.last()[0])
+
+        x, y = solution.sample([t - period])
+        self.assertAlmostEqual(math.hypot(x[0], y[0]), 1.0, places=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+# encoding: utf-8
+
+import unittest
+
+import numpy
+
+from dynamite.core.trajectory import Trajectory
+
+
+class TrajectoryTest(unittest.TestCase):
+
+    def test_alternating_growth(self):
+        # forward and backward chunks arrive interleaved when an orbit is extended in both directions
+        trajectory = Trajectory()
+        trajectory.append(0.0, 0.0, 0.0)
+
+        for n in xrange(1, 51):
+            rows = numpy.zeros((400, 3))
+            rows[:, 0] = numpy.arange(1, 401) + (n - 1) * 400
+            trajectory.extend(rows)
+            trajectory.prepend(-rows[::-1])
+
+        self.assertEqual(len(trajectory), 40001)
+        self.assertTrue((numpy.diff(trajectory.times()) > 0).all())
+        self.assertLessEqual(len(trajectory._buffer), 4 * len(trajectory))
+
+
+if __name__ == '__main__':
+    unittest.main()